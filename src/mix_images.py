@@ -1,12 +1,35 @@
 import argparse
+import io
+import math
 import mimetypes
 import os
 import time
 from google import genai
-from google.genai import types
+from google.genai import errors, types
+from PIL import Image, ImageOps
 
 MODEL_NAME = "gemini-2.5-flash-image-preview"
 
+# Images larger than this on their longest side are downscaled before upload;
+# the model does not see detail beyond its vision encoder's resolution.
+MAX_IMAGE_SIDE = 1024
+JPEG_QUALITY = 90
+
+# Local cache for results that can be reused across runs.
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "nano_banana",
+)
+
+# Lifetime of server-side cached prompt prefixes.
+CACHED_CONTENT_TTL_SECONDS = 3600
+
+# Errors returned when a referenced cache has expired or been deleted.
+STALE_CACHE_STATUS_CODES = {403, 404}
+
+# Explicit context caching rejects prefixes below this many input tokens.
+MIN_CACHED_CONTENT_TOKENS = 1024
+
 
 def remix_images(
     image_paths: list[str],
@@ -51,36 +74,121 @@ def _load_image_parts(image_paths: list[str]) -> list[types.Part]:
     for image_path in image_paths:
         with open(image_path, "rb") as f:
             image_data = f.read()
-        mime_type = _get_mime_type(image_path)
+        image_data, mime_type = _prepare_image_bytes(
+            image_data, _get_mime_type(image_path)
+        )
         parts.append(
             types.Part(inline_data=types.Blob(data=image_data, mime_type=mime_type))
         )
     return parts
 
 
+def _prepare_image_bytes(image_data: bytes, mime_type: str) -> tuple[bytes, str]:
+    """Downscales oversized images and re-encodes them, returning (bytes, mime type).
+
+    Images within MAX_IMAGE_SIDE, or that Pillow cannot decode, are returned unchanged.
+    """
+    try:
+        with Image.open(io.BytesIO(image_data)) as image:
+            if max(image.size) <= MAX_IMAGE_SIDE:
+                return image_data, mime_type
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+            buffer = io.BytesIO()
+            if "A" in image.getbands() or "transparency" in image.info:
+                image.save(buffer, format="PNG", optimize=True)
+                return buffer.getvalue(), "image/png"
+            image.convert("RGB").save(
+                buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True
+            )
+            return buffer.getvalue(), "image/jpeg"
+    except OSError:
+        return image_data, mime_type
+
+
+def _estimate_tokens(parts: list[types.Part]) -> int:
+    """Roughly estimates input tokens, following Gemini's 768 px image tiling."""
+    total = 0
+    for part in parts:
+        if part.inline_data and part.inline_data.data:
+            try:
+                with Image.open(io.BytesIO(part.inline_data.data)) as image:
+                    width, height = image.size
+            except OSError:
+                continue
+            if width <= 384 and height <= 384:
+                total += 258
+            else:
+                total += 258 * math.ceil(width / 768) * math.ceil(height / 768)
+        elif part.text:
+            total += len(part.text) // 4
+    return total
+
+
+def _create_cached_content(client: genai.Client, model: str, parts: list[types.Part]):
+    """Caches a shared prompt prefix server-side.
+
+    Returns the cache name, or None when the model or prefix does not support caching.
+    Prefixes clearly below MIN_CACHED_CONTENT_TOKENS are skipped without a request.
+    """
+    if _estimate_tokens(parts) < MIN_CACHED_CONTENT_TOKENS:
+        return None
+    try:
+        cache = client.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                contents=[types.Content(role="user", parts=parts)],
+                ttl=f"{CACHED_CONTENT_TTL_SECONDS}s",
+            ),
+        )
+    except errors.APIError as exc:
+        print(f"Context caching unavailable, sending full requests: {exc.message}")
+        return None
+    return cache.name
+
+
+def _delete_cached_content(client: genai.Client, name: str):
+    """Deletes a server-side cache, reporting rather than raising if that fails."""
+    try:
+        client.caches.delete(name=name)
+    except errors.APIError as exc:
+        print(f"Could not delete context cache {name}: {exc.message}")
+
+
 def _process_api_stream_response(stream, output_dir: str):
     """Processes the streaming response from the GenAI API, saving images and printing text."""
     file_index = 0
     for chunk in stream:
-        if (
-            chunk.candidates is None
-            or chunk.candidates[0].content is None
-            or chunk.candidates[0].content.parts is None
-        ):
-            continue
-
-        for part in chunk.candidates[0].content.parts:
-            if part.inline_data and part.inline_data.data:
-                timestamp = int(time.time())
-                file_extension = mimetypes.guess_extension(part.inline_data.mime_type)
-                file_name = os.path.join(
-                    output_dir,
-                    f"remixed_image_{timestamp}_{file_index}{file_extension}",
-                )
-                _save_binary_file(file_name, part.inline_data.data)
-                file_index += 1
-            elif part.text:
-                print(part.text)
+        file_index = _process_stream_chunk(chunk, output_dir, file_index)
+
+
+def _process_stream_chunk(
+    chunk, output_dir: str, file_index: int, label: str | None = None
+) -> int:
+    """Saves images and prints text from a single chunk, returning the next file index.
+
+    Text is prefixed with ``label`` so output from concurrent streams can be told apart.
+    """
+    if (
+        not chunk.candidates
+        or chunk.candidates[0].content is None
+        or chunk.candidates[0].content.parts is None
+    ):
+        return file_index
+
+    for part in chunk.candidates[0].content.parts:
+        if part.inline_data and part.inline_data.data:
+            timestamp = int(time.time())
+            file_extension = mimetypes.guess_extension(part.inline_data.mime_type)
+            file_name = os.path.join(
+                output_dir,
+                f"remixed_image_{timestamp}_{file_index}{file_extension}",
+            )
+            _save_binary_file(file_name, part.inline_data.data)
+            file_index += 1
+        elif part.text:
+            print(f"[{label}] {part.text}" if label else part.text)
+    return file_index
 
 
 def _save_binary_file(file_name: str, data: bytes):
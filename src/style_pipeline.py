@@ -6,18 +6,31 @@ then applies the style to each target photo.
 """
 
 import argparse
+import asyncio
+import functools
+import hashlib
+import json
 import os
 import pathlib
 import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 from typing import Iterable
 
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 
 from mix_images import (
+    CACHE_DIR,
     MODEL_NAME,
+    STALE_CACHE_STATUS_CODES,
+    _create_cached_content,
+    _delete_cached_content,
     _load_image_parts,
     _process_api_stream_response,
+    _process_stream_chunk,
 )
 
 STYLE_SUMMARY_INSTRUCTIONS = """
@@ -26,22 +39,98 @@ palette, texture, and any notable graphic elements in these reference
 postcards. Return 3-5 concise bullet points highlighting the style traits.
 """
 
+STYLE_SUMMARY_CACHE_DIR = os.path.join(CACHE_DIR, "style_summary")
+
+# Default upper bound on simultaneous image generations when restyling many
+# photos; override with NANOBANANA_MAX_CONCURRENCY.
+MAX_CONCURRENT_GENERATIONS = 4
+
+# Rate-limit and server errors are retried with exponential backoff.
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_GENERATION_ATTEMPTS = 5
+RETRY_BASE_DELAY_SECONDS = 2.0
+
+# Seconds to wait between status checks of a submitted batch job.
+BATCH_POLL_INTERVAL_SECONDS = 30
+# Batch jobs complete within 24 hours; stop waiting shortly after that.
+BATCH_TIMEOUT_SECONDS = 25 * 60 * 60
+# Any other state is final. The Gemini API backend may report BATCH_STATE_*
+# names that the SDK leaves unconverted.
+BATCH_ACTIVE_STATES = {
+    "JOB_STATE_QUEUED",
+    "JOB_STATE_PENDING",
+    "JOB_STATE_RUNNING",
+    "JOB_STATE_CANCELLING",
+    "JOB_STATE_PAUSED",
+    "JOB_STATE_UPDATING",
+    "BATCH_STATE_PENDING",
+    "BATCH_STATE_RUNNING",
+}
+BATCH_SUCCESS_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_PARTIALLY_SUCCEEDED",
+    "BATCH_STATE_SUCCEEDED",
+}
+
+
+@functools.lru_cache(maxsize=4)
+def _get_client(api_key: str) -> genai.Client:
+    """Share one client per API key so pipelines reuse its sync connection pool.
+
+    Only the sync surface may be used from this shared client: its ``.aio`` pool
+    is bound to the first event loop that uses it, so async runs open their own.
+    """
+    return genai.Client(api_key=api_key)
+
 
 class StylePipelineError(Exception):
     """Domain specific errors for the style pipeline."""
 
 
+def _max_concurrency() -> int:
+    """Read the generation concurrency limit from NANOBANANA_MAX_CONCURRENCY."""
+    raw = os.environ.get("NANOBANANA_MAX_CONCURRENCY")
+    if raw is None:
+        return MAX_CONCURRENT_GENERATIONS
+    try:
+        value = int(raw)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise StylePipelineError(
+            f"NANOBANANA_MAX_CONCURRENCY must be a positive integer, got {raw!r}."
+        )
+    return value
+
+
 class StylePipeline:
     def __init__(self, api_key: str, model_name: str = MODEL_NAME):
         if not api_key:
             raise StylePipelineError("GEMINI_API_KEY environment variable not set.")
-        self._client = genai.Client(api_key=api_key)
+        self._api_key = api_key
+        self._client = _get_client(api_key)
         self._model_name = model_name
+        self._max_concurrency = _max_concurrency()
+        self._cached_content: str | None = None
 
     def summarize_style(self, style_images: list[str]) -> str:
         """Generate a concise description of the reference style images."""
-        contents = _load_image_parts(style_images)
-        contents.append(types.Part.from_text(text=STYLE_SUMMARY_INSTRUCTIONS))
+        return self._summarize_style_parts(_load_image_parts(style_images))
+
+    def _summarize_style_parts(self, style_parts: list[types.Part]) -> str:
+        """Describe the style of already loaded image parts without mutating them.
+
+        Descriptions are cached on disk, keyed by the image bytes, so repeated
+        runs with the same references skip the model call.
+        """
+        cache_path = os.path.join(
+            STYLE_SUMMARY_CACHE_DIR, f"{self._style_summary_key(style_parts)}.txt"
+        )
+        if os.path.exists(cache_path):
+            with open(cache_path, encoding="utf-8") as f:
+                return f.read()
+
+        contents = [*style_parts, types.Part.from_text(text=STYLE_SUMMARY_INSTRUCTIONS)]
 
         response = self._client.models.generate_content(
             model=self._model_name,
@@ -60,8 +149,29 @@ class StylePipeline:
         style_description = "\n".join(description_parts).strip()
         if not style_description:
             raise StylePipelineError("Received an empty style description.")
+
+        # Write under a temporary name so a concurrent run never reads a
+        # partial description.
+        os.makedirs(STYLE_SUMMARY_CACHE_DIR, exist_ok=True)
+        fd, partial_path = tempfile.mkstemp(dir=STYLE_SUMMARY_CACHE_DIR, suffix=".partial")
+        try:
+            with open(fd, "w", encoding="utf-8") as f:
+                f.write(style_description)
+            os.replace(partial_path, cache_path)
+        except BaseException:
+            os.unlink(partial_path)
+            raise
         return style_description
 
+    def _style_summary_key(self, style_parts: list[types.Part]) -> str:
+        """Hash the raw image bytes, not file names, so edited files miss the cache."""
+        digest = hashlib.sha256()
+        for data in sorted(part.inline_data.data for part in style_parts):
+            digest.update(data)
+        digest.update(STYLE_SUMMARY_INSTRUCTIONS.encode())
+        digest.update(self._model_name.encode())
+        return digest.hexdigest()
+
     def build_prompt(self, base_prompt: str, style_description: str) -> str:
         """Construct the final prompt incorporating the style description."""
         return (
@@ -77,9 +187,30 @@ class StylePipeline:
         target_photos: Iterable[str],
         base_prompt: str,
         output_dir: str,
+        batch: bool = False,
     ) -> None:
-        """Run the full pipeline against all target photos."""
-        style_description = self.summarize_style(style_images)
+        """Run the full pipeline against all target photos.
+
+        With ``batch`` set, all photos are submitted as a single Gemini batch
+        job instead of one streaming request each.
+        """
+        target_photos = list(target_photos)
+        _check_distinct_stems(target_photos)
+
+        # Read the target photos in the background during the style summary
+        # and prompt review, so generation starts without touching the disk.
+        preloaded: OrderedDict[str, types.Part] = OrderedDict()
+        preloader = threading.Thread(
+            target=_preload_photo_parts,
+            args=(target_photos, preloaded),
+            daemon=True,
+        )
+        preloader.start()
+
+        # Read the reference images once; the same parts feed the style summary
+        # and every per-photo request.
+        style_parts = _load_image_parts(style_images)
+        style_description = self._summarize_style_parts(style_parts)
         final_prompt = self.build_prompt(base_prompt, style_description)
 
         print("Generated style description:\n")
@@ -93,32 +224,337 @@ class StylePipeline:
             return
 
         os.makedirs(output_dir, exist_ok=True)
+        preloader.join()
 
+        if batch:
+            self._apply_batch(
+                style_parts, target_photos, final_prompt, output_dir, preloaded
+            )
+            return
+
+        asyncio.run(
+            self._apply_to_photos(
+                style_parts, target_photos, final_prompt, output_dir, preloaded
+            )
+        )
+
+    def _apply_batch(
+        self,
+        style_parts: list[types.Part],
+        target_photos: Iterable[str],
+        final_prompt: str,
+        output_dir: str,
+        preloaded: dict[str, types.Part],
+    ) -> None:
+        """Restyle all target photos through one batch job and wait for it.
+
+        Requests are uploaded as a JSONL file, which avoids the size cap on
+        inline batch requests since every request repeats the style images.
+        The uploaded file is only deleted once the job can no longer read it.
+        """
+        photos: list[str] = []
         for photo_path in target_photos:
             if not os.path.exists(photo_path):
                 print(f"Skipping missing photo: {photo_path}")
                 continue
+            photos.append(photo_path)
+        if not photos:
+            print("No photos to process.")
+            return
 
-            print(f"\nProcessing {photo_path}...")
-            parts = _load_image_parts([*style_images, photo_path])
-            parts.append(types.Part.from_text(text=final_prompt))
+        fd, requests_path = tempfile.mkstemp(prefix="style_batch_", suffix=".jsonl")
+        try:
+            with open(fd, "w", encoding="utf-8") as f:
+                _write_batch_requests(f, photos, style_parts, final_prompt, preloaded)
+            requests_file = self._client.files.upload(
+                file=requests_path,
+                config=types.UploadFileConfig(
+                    display_name="style-pipeline-requests", mime_type="jsonl"
+                ),
+            )
+        finally:
+            os.unlink(requests_path)
 
-            stream = self._client.models.generate_content_stream(
+        try:
+            job = self._client.batches.create(
                 model=self._model_name,
-                contents=parts,
-                config=types.GenerateContentConfig(
-                    response_modalities=["IMAGE", "TEXT"],
-                ),
+                src=requests_file.name,
+                config=types.CreateBatchJobConfig(display_name="style-pipeline"),
+            )
+        except BaseException:
+            self._client.files.delete(name=requests_file.name)
+            raise
+        print(f"\nSubmitted batch job {job.name} for {len(photos)} photo(s).")
+
+        try:
+            job = self._wait_for_batch(job)
+        except KeyboardInterrupt:
+            # Don't leave a job running that nobody will collect.
+            self._cancel_batch(job)
+            raise
+        self._client.files.delete(name=requests_file.name)
+
+        if _batch_state(job) not in BATCH_SUCCESS_STATES or not job.dest:
+            raise StylePipelineError(
+                f"Batch job {job.name} finished with state {_batch_state(job)}."
+            )
+        results = self._client.files.download(file=job.dest.file_name)
+        failures = _save_batch_results(results, photos, output_dir)
+        if failures:
+            raise StylePipelineError(
+                f"Failed to restyle {len(failures)} photo(s): {', '.join(failures)}"
             )
 
-            target_name = pathlib.Path(photo_path).stem
-            target_output_dir = os.path.join(output_dir, target_name)
-            os.makedirs(target_output_dir, exist_ok=True)
-            _process_api_stream_response(
-                stream,
-                output_dir=target_output_dir,
+    def _wait_for_batch(self, job: types.BatchJob) -> types.BatchJob:
+        """Poll a batch job until it leaves the active states or times out."""
+        deadline = time.monotonic() + BATCH_TIMEOUT_SECONDS
+        while _batch_state(job) is None or _batch_state(job) in BATCH_ACTIVE_STATES:
+            if time.monotonic() > deadline:
+                raise StylePipelineError(
+                    f"Batch job {job.name} did not finish within "
+                    f"{BATCH_TIMEOUT_SECONDS // 3600} hours; it is still on the server."
+                )
+            time.sleep(BATCH_POLL_INTERVAL_SECONDS)
+            job = self._client.batches.get(name=job.name)
+            print(f"Batch job state: {_batch_state(job)}")
+        return job
+
+    def _cancel_batch(self, job: types.BatchJob) -> None:
+        """Ask the server to stop a batch job, reporting rather than raising on failure."""
+        try:
+            self._client.batches.cancel(name=job.name)
+        except errors.APIError as exc:
+            print(f"Could not cancel batch job {job.name}: {exc.message}")
+            return
+        print(f"Cancelled batch job {job.name}.")
+
+    async def _apply_to_photos(
+        self,
+        style_parts: list[types.Part],
+        target_photos: Iterable[str],
+        final_prompt: str,
+        output_dir: str,
+        preloaded: dict[str, types.Part],
+    ) -> None:
+        """Restyle all target photos concurrently, sharing the loaded style parts.
+
+        The style images are placed in a server-side context cache when
+        possible so each request only sends its own photo and the prompt.
+        """
+        semaphore = asyncio.Semaphore(self._max_concurrency)
+        failures: list[str] = []
+        prompt_part = types.Part.from_text(text=final_prompt)
+        self._cached_content = cached_content = _create_cached_content(
+            self._client, self._model_name, style_parts
+        )
+
+        async def _apply_one(aclient: genai.client.AsyncClient, photo_path: str) -> None:
+            if not os.path.exists(photo_path):
+                print(f"Skipping missing photo: {photo_path}")
+                return
+
+            async with semaphore:
+                print(f"\nProcessing {photo_path}...")
+                # A failing photo is reported without cancelling the others.
+                try:
+                    await self._generate(
+                        aclient,
+                        photo_path,
+                        style_parts,
+                        _photo_parts(photo_path, preloaded),
+                        prompt_part,
+                        _target_output_dir(output_dir, photo_path),
+                    )
+                except Exception as exc:
+                    print(f"Failed to restyle {photo_path}: {exc}")
+                    failures.append(photo_path)
+
+        try:
+            # The async client's connection pool is bound to the running event
+            # loop, so each run opens and closes its own.
+            async with genai.Client(api_key=self._api_key).aio as aclient:
+                await asyncio.gather(
+                    *(_apply_one(aclient, photo_path) for photo_path in target_photos)
+                )
+        finally:
+            self._cached_content = None
+            if cached_content:
+                _delete_cached_content(self._client, cached_content)
+
+        if failures:
+            raise StylePipelineError(
+                f"Failed to restyle {len(failures)} photo(s): {', '.join(failures)}"
             )
 
+    async def _generate(
+        self,
+        aclient: genai.client.AsyncClient,
+        photo_path: str,
+        style_parts: list[types.Part],
+        photo_parts: list[types.Part],
+        prompt_part: types.Part,
+        target_output_dir: str,
+    ) -> None:
+        """Stream one generation, backing off and retrying on 429/5xx responses.
+
+        Only attempts that have not saved an image yet are retried, so a stream
+        failing midway does not write its images twice. If the style cache has
+        expired, it is dropped and the style images are sent inline instead.
+        """
+        attempt = 1
+        while True:
+            cached_content = self._cached_content
+            # Keep the style, photo, prompt order with or without the cache.
+            if cached_content:
+                parts = [*photo_parts, prompt_part]
+            else:
+                parts = [*style_parts, *photo_parts, prompt_part]
+
+            file_index = 0
+            try:
+                stream = await aclient.models.generate_content_stream(
+                    model=self._model_name,
+                    contents=parts,
+                    config=types.GenerateContentConfig(
+                        response_modalities=["IMAGE", "TEXT"],
+                        cached_content=cached_content,
+                    ),
+                )
+                async for chunk in stream:
+                    file_index = _process_stream_chunk(
+                        chunk, target_output_dir, file_index, label=photo_path
+                    )
+                return
+            except errors.APIError as exc:
+                if file_index:
+                    raise
+                if cached_content and exc.code in STALE_CACHE_STATUS_CODES:
+                    print(f"Context cache expired, resending style images for {photo_path}.")
+                    self._cached_content = None
+                    continue
+                if (
+                    exc.code not in RETRYABLE_STATUS_CODES
+                    or attempt == MAX_GENERATION_ATTEMPTS
+                ):
+                    raise
+                delay = RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1)
+                print(
+                    f"API error {exc.code} for {photo_path}, "
+                    f"retrying in {delay:.0f}s ({attempt}/{MAX_GENERATION_ATTEMPTS})..."
+                )
+                attempt += 1
+                await asyncio.sleep(delay)
+
+
+def _batch_state(job: types.BatchJob) -> str | None:
+    """Return the job state name, or None while the server has not reported one."""
+    return job.state.name if job.state else None
+
+
+def _write_batch_requests(
+    f,
+    photos: list[str],
+    style_parts: list[types.Part],
+    final_prompt: str,
+    preloaded: dict[str, types.Part],
+) -> None:
+    """Write one JSONL request per photo, keyed by its index in ``photos``."""
+
+    def _to_json(part: types.Part) -> dict:
+        return part.model_dump(mode="json", by_alias=True, exclude_none=True)
+
+    # The style images are encoded once and repeated in every request.
+    prefix = [_to_json(part) for part in style_parts]
+    prompt = _to_json(types.Part.from_text(text=final_prompt))
+    generation_config = types.GenerationConfig(
+        response_modalities=["IMAGE", "TEXT"]
+    ).model_dump(mode="json", by_alias=True, exclude_none=True)
+
+    for index, photo_path in enumerate(photos):
+        photo = [_to_json(part) for part in _photo_parts(photo_path, preloaded)]
+        line = {
+            "key": str(index),
+            "request": {
+                "contents": [{"role": "user", "parts": [*prefix, *photo, prompt]}],
+                "generationConfig": generation_config,
+            },
+        }
+        f.write(json.dumps(line) + "\n")
+
+
+def _save_batch_results(results: bytes, photos: list[str], output_dir: str) -> list[str]:
+    """Save each batch result to its photo's folder, returning the photos that failed."""
+    pending = dict(enumerate(photos))
+    failures: list[str] = []
+    for raw_line in results.decode("utf-8").splitlines():
+        if not raw_line.strip():
+            continue
+        line = json.loads(raw_line)
+        photo_path = pending.pop(int(line["key"]), None)
+        if photo_path is None:
+            continue
+        print(f"\nResults for {photo_path}:")
+        if "response" not in line:
+            print(f"Request failed: {line.get('error')}")
+            failures.append(photo_path)
+            continue
+        response = types.GenerateContentResponse.model_validate_json(
+            json.dumps(line["response"])
+        )
+        # A batch response has the same shape as a single stream chunk.
+        _process_api_stream_response(
+            [response],
+            output_dir=_target_output_dir(output_dir, photo_path),
+        )
+
+    for photo_path in pending.values():
+        print(f"No batch result returned for {photo_path}")
+        failures.append(photo_path)
+    return failures
+
+
+def _preload_photo_parts(
+    target_photos: list[str], preloaded: OrderedDict[str, types.Part]
+) -> None:
+    """Load target photo parts into ``preloaded``; unreadable photos are left out."""
+    for photo_path in target_photos:
+        if photo_path in preloaded or not os.path.exists(photo_path):
+            continue
+        try:
+            preloaded[photo_path] = _load_image_parts([photo_path])[0]
+        except (OSError, ValueError):
+            # Loading again on the main path surfaces the error to the user.
+            continue
+
+
+def _photo_parts(photo_path: str, preloaded: dict[str, types.Part]) -> list[types.Part]:
+    """Return the parts for a target photo, preferring the preloaded copy."""
+    if photo_path in preloaded:
+        return [preloaded[photo_path]]
+    return _load_image_parts([photo_path])
+
+
+def _check_distinct_stems(target_photos: list[str]) -> None:
+    """Reject photos whose output folders, named after the file stem, would collide."""
+    seen: set[str] = set()
+    repeated: list[str] = []
+    for photo_path in target_photos:
+        stem = pathlib.Path(photo_path).stem
+        if stem in seen and stem not in repeated:
+            repeated.append(stem)
+        seen.add(stem)
+    if repeated:
+        raise StylePipelineError(
+            f"Target photos must have distinct file names; repeated: {', '.join(repeated)}"
+        )
+
+
+def _target_output_dir(output_dir: str, photo_path: str) -> str:
+    """Create and return the per-photo output directory."""
+    target_output_dir = os.path.join(output_dir, pathlib.Path(photo_path).stem)
+    os.makedirs(target_output_dir, exist_ok=True)
+    return target_output_dir
+
 
 def parse_args(argv: list[str]) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -154,6 +590,14 @@ def parse_args(argv: list[str]) -> argparse.Namespace:
         default="styled_output",
         help="Directory where styled images will be written.",
     )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help=(
+            "Submit all photos as one Gemini batch job instead of streaming each "
+            "request. Cheaper for bulk runs but results can take much longer."
+        ),
+    )
     return parser.parse_args(argv)
 
 
@@ -172,6 +616,7 @@ def main(argv: list[str] | None = None) -> int:
             target_photos=args.photos,
             base_prompt=args.base_prompt,
             output_dir=args.output_dir,
+            batch=args.batch,
         )
     except StylePipelineError as exc:
         print(f"Error: {exc}")
@@ -4,48 +4,127 @@ This app lets users upload 1-5 images, provide an optional prompt,
 and generate remixed images using the Gemini model.
 """
 
+import atexit
+import getpass
+import hashlib
 import os
+import shutil
+import stat
 import tempfile
-from typing import Iterable
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
 
 import streamlit as st
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 
-from mix_images import MODEL_NAME, _get_mime_type
+from mix_images import (
+    CACHED_CONTENT_TTL_SECONDS,
+    MODEL_NAME,
+    STALE_CACHE_STATUS_CODES,
+    _create_cached_content,
+    _delete_cached_content,
+    _get_mime_type,
+    _prepare_image_bytes,
+)
 
+# Chunk size used when copying uploads to disk.
+UPLOAD_COPY_CHUNK_SIZE = 1024 * 1024
 
-def _save_uploads(uploaded_files: Iterable[UploadedFile]) -> list[str]:
-    """Persist uploaded files to temporary paths and return their locations."""
-    temp_dir = tempfile.mkdtemp(prefix="remix_uploads_")
-    saved_paths: list[str] = []
-    for uploaded in uploaded_files:
-        file_path = os.path.join(temp_dir, uploaded.name)
-        with open(file_path, "wb") as f:
-            f.write(uploaded.getbuffer())
-        saved_paths.append(file_path)
-    return saved_paths
+# Upper bound on threads writing uploads concurrently.
+MAX_UPLOAD_WRITERS = 8
+
+# Stop reusing a server-side cache this many seconds before it expires.
+CACHED_CONTENT_EXPIRY_MARGIN_SECONDS = 60
+
+
+def _upload_tmp_root() -> str:
+    """Directory for upload staging; set NANOBANANA_TMPDIR to point at a tmpfs."""
+    return os.environ.get("NANOBANANA_TMPDIR") or tempfile.gettempdir()
+
+
+def _upload_store_dir() -> str:
+    """Create and return this user's content-addressed upload store.
+
+    The staging root is usually the shared temp dir, so the store is kept
+    private and a directory planted there by someone else is refused.
+    """
+    has_uid = hasattr(os, "getuid")
+    owner = os.getuid() if has_uid else getpass.getuser()
+    store_dir = os.path.join(_upload_tmp_root(), f"nano_banana_blobs_{owner}")
+    os.makedirs(store_dir, mode=0o700, exist_ok=True)
+    info = os.lstat(store_dir)
+    if not stat.S_ISDIR(info.st_mode) or (has_uid and info.st_uid != os.getuid()):
+        raise PermissionError(
+            f"Refusing to use {store_dir}: not a directory owned by the current user."
+        )
+    if stat.S_IMODE(info.st_mode) & 0o077:
+        os.chmod(store_dir, 0o700)
+    return store_dir
+
+
+def _upload_digest(uploaded: UploadedFile) -> str:
+    """Hash the uploaded bytes so identical images share a key across sessions."""
+    with uploaded.getbuffer() as data:
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
 
 
-def _process_stream_to_memory(stream) -> tuple[list[bytes], list[str]]:
-    """Read a streaming response, returning image bytes and text parts."""
-    images: list[bytes] = []
-    texts: list[str] = []
+def _save_uploads(uploaded_files: Iterable[UploadedFile]) -> list[tuple[str, str]]:
+    """Persist uploads to the content-addressed store, returning (path, digest) pairs.
+
+    Files already present under the same digest are reused without rewriting.
+    """
+    uploaded_files = list(uploaded_files)
+    if not uploaded_files:
+        return []
+    store_dir = _upload_store_dir()
+
+    def _persist_one(uploaded: UploadedFile) -> tuple[str, str]:
+        digest = _upload_digest(uploaded)
+        extension = os.path.splitext(uploaded.name)[1].lower()
+        file_path = os.path.join(store_dir, f"{digest}{extension}")
+        if os.path.exists(file_path):
+            return file_path, digest
+
+        # Write under a temporary name so concurrent sessions never see a
+        # partially written blob. Uploads are in-memory BytesIO objects with no
+        # backing file, so there is nothing to link or sendfile from.
+        fd, partial_path = tempfile.mkstemp(dir=store_dir, suffix=".partial")
+        try:
+            uploaded.seek(0)
+            with open(fd, "wb", buffering=UPLOAD_COPY_CHUNK_SIZE) as f:
+                shutil.copyfileobj(uploaded, f, length=UPLOAD_COPY_CHUNK_SIZE)
+            os.replace(partial_path, file_path)
+        except BaseException:
+            os.unlink(partial_path)
+            raise
+        return file_path, digest
+
+    workers = min(MAX_UPLOAD_WRITERS, len(uploaded_files))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_persist_one, uploaded_files))
+
+
+def _iter_stream(stream) -> Iterator[tuple[str, bytes | str]]:
+    """Yield ("image", bytes) and ("text", str) parts as the stream delivers them."""
+    # Streams emit many small chunks, so attribute lookups are done once per
+    # chunk and part.
     for chunk in stream:
-        if (
-            chunk.candidates is None
-            or chunk.candidates[0].content is None
-            or chunk.candidates[0].content.parts is None
-        ):
+        candidates = chunk.candidates
+        if not candidates:
             continue
-
-        for part in chunk.candidates[0].content.parts:
-            if part.inline_data and part.inline_data.data:
-                images.append(part.inline_data.data)
-            elif part.text:
-                texts.append(part.text)
-    return images, texts
+        parts = getattr(candidates[0].content, "parts", None) or ()
+        for part in parts:
+            data = getattr(part.inline_data, "data", None)
+            if data:
+                yield "image", data
+                continue
+            text = part.text
+            if text:
+                yield "text", text
 
 
 def _build_prompt(prompt: str, num_images: int) -> str:
@@ -56,23 +135,105 @@ def _build_prompt(prompt: str, num_images: int) -> str:
     return "Combine the subjects of these images in a natural way, producing a new image."
 
 
-def _remix_images(image_paths: list[str], prompt: str, api_key: str) -> tuple[list[bytes], list[str]]:
-    contents = []
-    for image_path in image_paths:
-        with open(image_path, "rb") as f:
-            image_data = f.read()
-        contents.append(
-            types.Part(inline_data=types.Blob(data=image_data, mime_type=_get_mime_type(image_path)))
+@st.cache_resource
+def _get_client(api_key: str) -> genai.Client:
+    """Share one client, and its connection pool, across reruns and sessions."""
+    return genai.Client(api_key=api_key)
+
+
+@st.cache_resource
+def _cached_content_registry() -> dict[tuple[str, ...], tuple[str | None, float]]:
+    """Server-side cache names by API key and upload digests, with monotonic expiry times.
+
+    A None name records that caching was rejected for that image set.
+    """
+    registry: dict[tuple[str, ...], tuple[str | None, float]] = {}
+    atexit.register(_delete_cached_contents, registry)
+    return registry
+
+
+@st.cache_resource
+def _cached_content_lock() -> threading.Lock:
+    """Serialize registry access so concurrent sessions create each cache once."""
+    return threading.Lock()
+
+
+def _delete_cached_contents(registry: dict[tuple[str, ...], tuple[str | None, float]]):
+    """Delete the server-side caches this process created, rather than wait for the TTL."""
+    for (api_key, *_), (name, _) in list(registry.items()):
+        if name:
+            _delete_cached_content(genai.Client(api_key=api_key), name)
+
+
+def _get_cached_content(key: tuple[str, ...], image_parts: list[types.Part]) -> str | None:
+    """Return a live cache over these images, creating one on first use."""
+    registry = _cached_content_registry()
+    with _cached_content_lock():
+        entry = registry.get(key)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+
+        name = _create_cached_content(_get_client(key[0]), MODEL_NAME, image_parts)
+        registry[key] = (
+            name,
+            time.monotonic() + CACHED_CONTENT_TTL_SECONDS - CACHED_CONTENT_EXPIRY_MARGIN_SECONDS,
         )
-    contents.append(types.Part.from_text(text=prompt))
+        return name
 
-    client = genai.Client(api_key=api_key)
-    stream = client.models.generate_content_stream(
+
+def _generate_stream(
+    client: genai.Client, contents: list[types.Part], cached_content: str | None
+):
+    """Start a streaming image generation, optionally on top of a cached prefix."""
+    return client.models.generate_content_stream(
         model=MODEL_NAME,
         contents=contents,
-        config=types.GenerateContentConfig(response_modalities=["IMAGE", "TEXT"]),
+        config=types.GenerateContentConfig(
+            response_modalities=["IMAGE", "TEXT"],
+            cached_content=cached_content,
+        ),
     )
-    return _process_stream_to_memory(stream)
+
+
+def _remix_images(
+    uploaded_files: list[UploadedFile], prompt: str, api_key: str
+) -> Iterator[tuple[str, bytes | str]]:
+    image_parts = []
+    for uploaded in uploaded_files:
+        image_data, mime_type = _prepare_image_bytes(
+            uploaded.getvalue(), _get_mime_type(uploaded.name)
+        )
+        image_parts.append(
+            types.Part(inline_data=types.Blob(data=image_data, mime_type=mime_type))
+        )
+    prompt_part = types.Part.from_text(text=prompt)
+
+    client = _get_client(api_key)
+    # Re-uploads of the same images reuse their server-side cache, so only the
+    # prompt is sent.
+    key = (api_key, *(_upload_digest(uploaded) for uploaded in uploaded_files))
+    cached_content = _get_cached_content(key, image_parts)
+    if cached_content:
+        started = False
+        try:
+            for item in _iter_stream(
+                _generate_stream(client, [prompt_part], cached_content)
+            ):
+                started = True
+                yield item
+            return
+        except errors.ClientError as exc:
+            # A cache that expired early or was deleted is dropped and the
+            # request is resent in full, as long as nothing was shown yet.
+            if started or exc.code not in STALE_CACHE_STATUS_CODES:
+                raise
+            with _cached_content_lock():
+                registry = _cached_content_registry()
+                # Another session may already have replaced the stale entry.
+                if registry.get(key, (None,))[0] == cached_content:
+                    del registry[key]
+
+    yield from _iter_stream(_generate_stream(client, [*image_parts, prompt_part], None))
 
 
 def main():
@@ -116,27 +277,37 @@ def main():
             return
 
         prompt = _build_prompt(prompt_input, len(uploaded_images))
+        # Results are rendered as they stream in; each image is only held until
+        # its widgets are drawn.
+        messages = st.container()
+        results = st.container()
+        has_messages = False
+        image_count = 0
         with st.spinner("Remixing images..."):
-            saved_paths = _save_uploads(uploaded_images)
-            images, texts = _remix_images(saved_paths, prompt, api_key)
-
-        if texts:
-            st.subheader("Model messages")
-            for text in texts:
-                st.write(text)
-
-        if images:
-            st.subheader("Remixed images")
-            for idx, image_bytes in enumerate(images, start=1):
-                st.image(image_bytes, caption=f"Result {idx}")
-                st.download_button(
-                    label=f"Download image {idx}",
-                    data=image_bytes,
-                    file_name=f"remixed_image_{idx}.png",
+            if os.environ.get("NANOBANANA_DEBUG_SAVE"):
+                saved = _save_uploads(uploaded_images)
+                st.caption(f"Uploads saved to {os.path.dirname(saved[0][0])}")
+            for kind, payload in _remix_images(uploaded_images, prompt, api_key):
+                if kind == "text":
+                    if not has_messages:
+                        messages.subheader("Model messages")
+                        has_messages = True
+                    messages.write(payload)
+                    continue
+
+                if not image_count:
+                    results.subheader("Remixed images")
+                image_count += 1
+                results.image(payload, caption=f"Result {image_count}")
+                results.download_button(
+                    label=f"Download image {image_count}",
+                    data=payload,
+                    file_name=f"remixed_image_{image_count}.png",
                     mime="image/png",
                     use_container_width=True,
                 )
-        else:
+
+        if not image_count:
             st.info("No images were returned by the model. Try again with a different prompt or inputs.")
 
 
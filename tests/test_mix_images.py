@@ -1,6 +1,22 @@
+import io
 import os
 import subprocess
 from pathlib import Path
+from types import SimpleNamespace
+
+from google.genai import errors, types
+from PIL import Image
+
+from mix_images import (
+    MAX_IMAGE_SIDE,
+    MIN_CACHED_CONTENT_TOKENS,
+    MODEL_NAME,
+    _create_cached_content,
+    _delete_cached_content,
+    _estimate_tokens,
+    _prepare_image_bytes,
+    _process_stream_chunk,
+)
 
 
 def test_mix_images_cli_integration(tmp_path):
@@ -49,3 +65,88 @@ def test_mix_images_cli_integration(tmp_path):
 
     # Assert that at least one remixed image file was created
     assert any(f.name.startswith("remixed_image_") for f in output_dir.iterdir())
+
+
+def _png_bytes(size, mode="RGB"):
+    buffer = io.BytesIO()
+    Image.new(mode, size).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_prepare_image_bytes_downscales_opaque_images_to_jpeg():
+    data, mime_type = _prepare_image_bytes(_png_bytes((3000, 2000)), "image/png")
+
+    assert mime_type == "image/jpeg"
+    with Image.open(io.BytesIO(data)) as image:
+        assert image.format == "JPEG"
+        assert image.size == (MAX_IMAGE_SIDE, 683)
+
+
+def test_prepare_image_bytes_keeps_transparency_as_png():
+    data, mime_type = _prepare_image_bytes(
+        _png_bytes((2000, 3000), mode="RGBA"), "image/png"
+    )
+
+    assert mime_type == "image/png"
+    with Image.open(io.BytesIO(data)) as image:
+        assert image.mode == "RGBA"
+        assert max(image.size) == MAX_IMAGE_SIDE
+
+
+def test_prepare_image_bytes_passes_through_small_and_undecodable_images():
+    small = _png_bytes((MAX_IMAGE_SIDE, 10))
+
+    assert _prepare_image_bytes(small, "image/png") == (small, "image/png")
+    assert _prepare_image_bytes(b"not an image", "image/png") == (
+        b"not an image",
+        "image/png",
+    )
+
+
+def test_create_cached_content_skips_small_prefixes():
+    class Caches:
+        def create(self, **kwargs):
+            raise AssertionError("caches.create should not be called")
+
+    client = SimpleNamespace(caches=Caches())
+    parts = [
+        types.Part(
+            inline_data=types.Blob(data=_png_bytes((300, 300)), mime_type="image/png")
+        ),
+        types.Part.from_text(text="short prompt"),
+    ]
+
+    assert _estimate_tokens(parts) < MIN_CACHED_CONTENT_TOKENS
+    assert _create_cached_content(client, MODEL_NAME, parts) is None
+
+
+def test_delete_cached_content_reports_api_errors(capsys):
+    class Caches:
+        def delete(self, name):
+            raise errors.ClientError(403, {"error": {"code": 403, "message": "denied"}})
+
+    _delete_cached_content(SimpleNamespace(caches=Caches()), "cachedContents/1")
+
+    assert "cachedContents/1" in capsys.readouterr().out
+
+
+def test_process_stream_chunk_saves_images_and_labels_text(tmp_path, capsys):
+    chunk = types.GenerateContentResponse(
+        candidates=[
+            types.Candidate(
+                content=types.Content(
+                    parts=[
+                        types.Part(
+                            inline_data=types.Blob(data=b"png", mime_type="image/png")
+                        ),
+                        types.Part.from_text(text="hello"),
+                    ]
+                )
+            )
+        ]
+    )
+
+    assert _process_stream_chunk(chunk, str(tmp_path), 0, label="a.jpg") == 1
+    assert _process_stream_chunk(types.GenerateContentResponse(), str(tmp_path), 1) == 1
+    assert [f.read_bytes() for f in tmp_path.iterdir()] == [b"png"]
+    assert "[a.jpg] hello" in capsys.readouterr().out
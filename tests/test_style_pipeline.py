@@ -0,0 +1,383 @@
+import asyncio
+import io
+import json
+import os
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+from google.genai import errors, types
+
+import style_pipeline
+from style_pipeline import StylePipeline, StylePipelineError
+
+
+def _image_part(data: bytes) -> types.Part:
+    return types.Part(inline_data=types.Blob(data=data, mime_type="image/png"))
+
+
+def _image_chunk(data: bytes) -> types.GenerateContentResponse:
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(parts=[_image_part(data)]))]
+    )
+
+
+def _api_error(code: int) -> errors.APIError:
+    return errors.APIError(code, {"error": {"code": code, "message": "boom"}})
+
+
+class _FakeAsyncModels:
+    """Serves one scripted outcome per generate_content_stream call."""
+
+    def __init__(self, outcomes):
+        self._outcomes = list(outcomes)
+        self.calls = 0
+        self.requests = []
+
+    async def generate_content_stream(self, **kwargs):
+        self.calls += 1
+        self.requests.append((len(kwargs["contents"]), kwargs["config"].cached_content))
+        chunks, error = self._outcomes.pop(0)
+
+        async def _stream():
+            for chunk in chunks:
+                yield chunk
+            if error:
+                raise error
+
+        return _stream()
+
+
+def _generate(pipeline, models, output_dir, style_parts=()):
+    return asyncio.run(
+        pipeline._generate(
+            SimpleNamespace(models=models),
+            "a.jpg",
+            list(style_parts),
+            [_image_part(b"photo")],
+            types.Part.from_text(text="prompt"),
+            str(output_dir),
+        )
+    )
+
+
+@pytest.fixture
+def pipeline(monkeypatch, tmp_path):
+    monkeypatch.setattr(style_pipeline, "RETRY_BASE_DELAY_SECONDS", 0)
+    monkeypatch.setattr(
+        style_pipeline, "STYLE_SUMMARY_CACHE_DIR", str(tmp_path / "summaries")
+    )
+    monkeypatch.delenv("NANOBANANA_MAX_CONCURRENCY", raising=False)
+    return StylePipeline(api_key="test-key")
+
+
+def test_style_summary_key_hashes_bytes_not_order(pipeline):
+    a, b = _image_part(b"first"), _image_part(b"second")
+
+    assert pipeline._style_summary_key([a, b]) == pipeline._style_summary_key([b, a])
+    assert pipeline._style_summary_key([a, b]) != pipeline._style_summary_key(
+        [a, _image_part(b"edited")]
+    )
+
+
+def test_summary_is_cached_on_disk(pipeline):
+    calls = []
+
+    def generate_content(**kwargs):
+        calls.append(kwargs)
+        return types.GenerateContentResponse(
+            candidates=[
+                types.Candidate(
+                    content=types.Content(parts=[types.Part.from_text(text="- bold ")])
+                )
+            ]
+        )
+
+    pipeline._client = SimpleNamespace(
+        models=SimpleNamespace(generate_content=generate_content)
+    )
+    parts = [_image_part(b"style")]
+
+    assert pipeline._summarize_style_parts(parts) == "- bold"
+    assert pipeline._summarize_style_parts(parts) == "- bold"
+    assert len(calls) == 1
+    cached = os.listdir(style_pipeline.STYLE_SUMMARY_CACHE_DIR)
+    assert len(cached) == 1 and cached[0].endswith(".txt")
+
+
+@pytest.mark.parametrize("value", ["0", "-2", "four"])
+def test_invalid_max_concurrency_is_rejected(monkeypatch, value):
+    monkeypatch.setenv("NANOBANANA_MAX_CONCURRENCY", value)
+
+    with pytest.raises(StylePipelineError, match="NANOBANANA_MAX_CONCURRENCY"):
+        StylePipeline(api_key="test-key")
+
+
+def test_retries_rate_limits_before_any_image_is_saved(pipeline, tmp_path):
+    models = _FakeAsyncModels(
+        [([], _api_error(429)), ([_image_chunk(b"img")], None)]
+    )
+
+    _generate(pipeline, models, tmp_path)
+
+    assert models.calls == 2
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_does_not_retry_once_an_image_was_saved(pipeline, tmp_path):
+    models = _FakeAsyncModels(
+        [([_image_chunk(b"img")], _api_error(503)), ([_image_chunk(b"img")], None)]
+    )
+
+    with pytest.raises(errors.APIError):
+        _generate(pipeline, models, tmp_path)
+
+    assert models.calls == 1
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_does_not_retry_client_errors(pipeline, tmp_path):
+    models = _FakeAsyncModels([([], _api_error(400))])
+
+    with pytest.raises(errors.APIError):
+        _generate(pipeline, models, tmp_path)
+
+    assert models.calls == 1
+
+
+def test_one_failing_photo_does_not_stop_the_others(pipeline, monkeypatch, tmp_path):
+    async def generate(self, aclient, photo_path, *parts_and_output_dir):
+        output_dir = parts_and_output_dir[-1]
+        if photo_path.endswith("bad.jpg"):
+            raise ValueError("unsupported")
+        open(os.path.join(output_dir, "out.png"), "wb").close()
+
+    monkeypatch.setattr(StylePipeline, "_generate", generate)
+    monkeypatch.setattr(style_pipeline, "_create_cached_content", lambda *args: None)
+    photos = [str(tmp_path / "bad.jpg"), str(tmp_path / "good.jpg")]
+    for photo_path in photos:
+        open(photo_path, "wb").close()
+    preloaded = {photo_path: _image_part(b"photo") for photo_path in photos}
+    output_dir = tmp_path / "out"
+
+    with pytest.raises(StylePipelineError, match="bad.jpg"):
+        asyncio.run(
+            pipeline._apply_to_photos([], photos, "prompt", str(output_dir), preloaded)
+        )
+
+    assert (output_dir / "good" / "out.png").exists()
+
+
+def test_stale_cache_falls_back_to_full_request(pipeline, tmp_path):
+    models = _FakeAsyncModels([([], _api_error(404)), ([_image_chunk(b"img")], None)])
+    pipeline._cached_content = "cachedContents/expired"
+
+    _generate(pipeline, models, tmp_path, style_parts=[_image_part(b"style")])
+
+    assert models.requests == [(2, "cachedContents/expired"), (3, None)]
+    assert pipeline._cached_content is None
+
+
+def test_cache_delete_errors_do_not_mask_results(pipeline, monkeypatch, tmp_path):
+    async def generate(self, aclient, photo_path, *parts_and_output_dir):
+        open(os.path.join(parts_and_output_dir[-1], "out.png"), "wb").close()
+
+    def delete(name):
+        raise _api_error(403)
+
+    monkeypatch.setattr(StylePipeline, "_generate", generate)
+    monkeypatch.setattr(
+        style_pipeline, "_create_cached_content", lambda *args: "cachedContents/1"
+    )
+    pipeline._client = SimpleNamespace(caches=SimpleNamespace(delete=delete))
+    photo_path = str(tmp_path / "a.jpg")
+    open(photo_path, "wb").close()
+
+    asyncio.run(
+        pipeline._apply_to_photos(
+            [], [photo_path], "prompt", str(tmp_path / "out"), {photo_path: _image_part(b"a")}
+        )
+    )
+
+    assert (tmp_path / "out" / "a" / "out.png").exists()
+
+
+def test_duplicate_photo_stems_are_rejected(pipeline):
+    with pytest.raises(StylePipelineError, match="distinct file names; repeated: beach"):
+        pipeline.apply_style(
+            ["s1.png", "s2.png"], ["a/beach.jpg", "b/beach.png", "c.jpg"], "prompt", "out"
+        )
+
+
+def test_write_batch_requests_uses_the_rest_wire_format(tmp_path):
+    photo_path = str(tmp_path / "a.jpg")
+    buffer = io.StringIO()
+
+    style_pipeline._write_batch_requests(
+        buffer,
+        [photo_path],
+        [_image_part(b"style")],
+        "prompt",
+        {photo_path: _image_part(b"photo")},
+    )
+
+    (line,) = [json.loads(raw) for raw in buffer.getvalue().splitlines()]
+    assert line["key"] == "0"
+    request = line["request"]
+    parts = request["contents"][0]["parts"]
+    assert [part.get("inlineData", {}).get("data") for part in parts] == [
+        "c3R5bGU=",
+        "cGhvdG8=",
+        None,
+    ]
+    assert parts[-1] == {"text": "prompt"}
+    assert request["generationConfig"] == {"responseModalities": ["IMAGE", "TEXT"]}
+
+
+class _FakeBatchClient:
+    """Records file and batch calls; ``states`` are returned by successive polls."""
+
+    def __init__(self, states, results=b""):
+        self.events = []
+        self._states = list(states)
+        self._results = results
+        self.files = SimpleNamespace(
+            upload=self._upload, delete=self._delete, download=self._download
+        )
+        self.batches = SimpleNamespace(
+            create=self._create, get=self._get, cancel=self._cancel
+        )
+
+    def _upload(self, file, config):
+        self.events.append("upload")
+        return types.File(name="files/requests")
+
+    def _delete(self, name):
+        self.events.append(f"delete {name}")
+
+    def _download(self, file):
+        self.events.append(f"download {file}")
+        return self._results
+
+    def _create(self, model, src, config):
+        self.events.append(f"create {src}")
+        return types.BatchJob(name="batches/1", state="JOB_STATE_PENDING")
+
+    def _get(self, name):
+        state = self._states.pop(0)
+        if isinstance(state, BaseException):
+            raise state
+        self.events.append(f"poll {state}")
+        return types.BatchJob(
+            name=name,
+            state=state,
+            dest=types.BatchJobDestination(file_name="files/results"),
+        )
+
+    def _cancel(self, name):
+        self.events.append(f"cancel {name}")
+
+
+@pytest.fixture
+def batch_photo(monkeypatch, tmp_path):
+    monkeypatch.setattr(style_pipeline, "BATCH_POLL_INTERVAL_SECONDS", 0)
+    photo_path = str(tmp_path / "a.jpg")
+    open(photo_path, "wb").close()
+    return photo_path
+
+
+def _apply_batch(pipeline, client, photo_path, output_dir):
+    pipeline._client = client
+    pipeline._apply_batch(
+        [_image_part(b"style")],
+        [photo_path],
+        "prompt",
+        str(output_dir),
+        {photo_path: _image_part(b"photo")},
+    )
+
+
+def test_apply_batch_deletes_input_only_after_the_job_finishes(
+    pipeline, batch_photo, tmp_path
+):
+    result = {"key": "0", "response": {"candidates": []}}
+    client = _FakeBatchClient(
+        ["JOB_STATE_RUNNING", "JOB_STATE_CANCELLING", "JOB_STATE_SUCCEEDED"],
+        results=json.dumps(result).encode(),
+    )
+
+    _apply_batch(pipeline, client, batch_photo, tmp_path / "out")
+
+    assert client.events == [
+        "upload",
+        "create files/requests",
+        "poll JOB_STATE_RUNNING",
+        "poll JOB_STATE_CANCELLING",
+        "poll JOB_STATE_SUCCEEDED",
+        "delete files/requests",
+        "download files/results",
+    ]
+
+
+def test_apply_batch_cancels_the_job_when_interrupted(pipeline, batch_photo, tmp_path):
+    client = _FakeBatchClient(["JOB_STATE_RUNNING", KeyboardInterrupt()])
+
+    with pytest.raises(KeyboardInterrupt):
+        _apply_batch(pipeline, client, batch_photo, tmp_path / "out")
+
+    assert client.events[-1] == "cancel batches/1"
+    assert "delete files/requests" not in client.events
+
+
+def test_apply_batch_keeps_input_when_the_wait_times_out(
+    pipeline, batch_photo, monkeypatch, tmp_path
+):
+    monkeypatch.setattr(style_pipeline, "BATCH_TIMEOUT_SECONDS", -1)
+    client = _FakeBatchClient([])
+
+    with pytest.raises(StylePipelineError, match="still on the server"):
+        _apply_batch(pipeline, client, batch_photo, tmp_path / "out")
+
+    assert client.events == ["upload", "create files/requests"]
+
+
+def test_preload_skips_missing_photos_and_is_preferred(tmp_path):
+    present, missing = tmp_path / "a.png", tmp_path / "missing.png"
+    present.write_bytes(b"on disk")
+    preloaded = OrderedDict()
+
+    style_pipeline._preload_photo_parts([str(missing), str(present)], preloaded)
+
+    assert list(preloaded) == [str(present)]
+    preloaded[str(present)] = _image_part(b"preloaded")
+    (part,) = style_pipeline._photo_parts(str(present), preloaded)
+    assert part.inline_data.data == b"preloaded"
+
+
+def test_batch_state_handles_missing_and_unconverted_states():
+    assert style_pipeline._batch_state(types.BatchJob()) is None
+    assert (
+        style_pipeline._batch_state(types.BatchJob(state="BATCH_STATE_EXPIRED"))
+        not in style_pipeline.BATCH_ACTIVE_STATES
+    )
+
+
+def test_save_batch_results_reports_missing_and_failed_photos(tmp_path):
+    response = {
+        "candidates": [
+            {"content": {"parts": [{"inlineData": {"mimeType": "image/png", "data": "AAE="}}]}}
+        ]
+    }
+    results = "\n".join(
+        [
+            json.dumps({"key": "0", "response": response}),
+            json.dumps({"key": "1", "error": {"message": "rejected"}}),
+        ]
+    ).encode()
+
+    failures = style_pipeline._save_batch_results(
+        results, ["a.jpg", "b.jpg", "c.jpg"], str(tmp_path)
+    )
+
+    assert failures == ["b.jpg", "c.jpg"]
+    assert [f.read_bytes() for f in (tmp_path / "a").iterdir()] == [b"\x00\x01"]
@@ -0,0 +1,112 @@
+import os
+import stat
+from types import SimpleNamespace
+
+import pytest
+from google.genai import errors, types
+from streamlit.proto.Common_pb2 import FileURLs
+from streamlit.runtime.uploaded_file_manager import UploadedFile, UploadedFileRec
+
+import ui_app
+
+
+def _upload(name: str, data: bytes) -> UploadedFile:
+    record = UploadedFileRec(file_id=name, name=name, type="image/png", data=data)
+    return UploadedFile(record, FileURLs())
+
+
+def _text_chunk(text: str) -> types.GenerateContentResponse:
+    return types.GenerateContentResponse(
+        candidates=[
+            types.Candidate(content=types.Content(parts=[types.Part.from_text(text=text)]))
+        ]
+    )
+
+
+def test_iter_stream_skips_empty_chunks():
+    image = types.Part(inline_data=types.Blob(data=b"png", mime_type="image/png"))
+    stream = [
+        types.GenerateContentResponse(),
+        types.GenerateContentResponse(candidates=[]),
+        types.GenerateContentResponse(candidates=[types.Candidate()]),
+        types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(parts=[image]))]
+        ),
+        _text_chunk("done"),
+    ]
+
+    assert list(ui_app._iter_stream(stream)) == [("image", b"png"), ("text", "done")]
+
+
+def test_save_uploads_dedupes_by_content(monkeypatch, tmp_path):
+    monkeypatch.setenv("NANOBANANA_TMPDIR", str(tmp_path))
+
+    saved = ui_app._save_uploads(
+        [_upload("a.png", b"same"), _upload("b.PNG", b"same"), _upload("c.png", b"other")]
+    )
+
+    (first, first_digest), (second, second_digest), (third, _) = saved
+    assert first == second and first_digest == second_digest
+    assert first != third
+    store = os.path.dirname(first)
+    assert store == ui_app._upload_store_dir()
+    assert os.path.dirname(store) == str(tmp_path)
+    assert stat.S_IMODE(os.stat(store).st_mode) == 0o700
+    assert sorted(os.listdir(store)) == sorted(
+        os.path.basename(path) for path in {first, third}
+    )
+    with open(first, "rb") as f:
+        assert f.read() == b"same"
+
+
+def test_upload_store_is_private_and_rejects_symlinks(monkeypatch, tmp_path):
+    monkeypatch.setenv("NANOBANANA_TMPDIR", str(tmp_path))
+    store = ui_app._upload_store_dir()
+    os.chmod(store, 0o755)
+
+    assert ui_app._upload_store_dir() == store
+    assert stat.S_IMODE(os.stat(store).st_mode) == 0o700
+
+    os.rename(store, tmp_path / "elsewhere")
+    os.symlink(tmp_path / "elsewhere", store)
+    with pytest.raises(PermissionError):
+        ui_app._upload_store_dir()
+
+
+def test_remix_images_resends_full_request_when_cache_is_stale(monkeypatch):
+    calls = []
+
+    def generate_content_stream(model, contents, config):
+        calls.append((len(contents), config.cached_content))
+        if config.cached_content:
+            raise errors.ClientError(
+                403, {"error": {"code": 403, "message": "CachedContent not found"}}
+            )
+        return iter([_text_chunk("ok")])
+
+    client = SimpleNamespace(
+        models=SimpleNamespace(generate_content_stream=generate_content_stream)
+    )
+    monkeypatch.setattr(ui_app, "_get_client", lambda api_key: client)
+    monkeypatch.setattr(
+        ui_app, "_get_cached_content", lambda key, parts: "cachedContents/stale"
+    )
+
+    results = list(ui_app._remix_images([_upload("a.png", b"img")], "prompt", "key"))
+
+    assert results == [("text", "ok")]
+    assert calls == [(1, "cachedContents/stale"), (2, None)]
+
+
+def test_remix_images_raises_other_client_errors(monkeypatch):
+    def generate_content_stream(model, contents, config):
+        raise errors.ClientError(400, {"error": {"code": 400, "message": "bad"}})
+
+    client = SimpleNamespace(
+        models=SimpleNamespace(generate_content_stream=generate_content_stream)
+    )
+    monkeypatch.setattr(ui_app, "_get_client", lambda api_key: client)
+    monkeypatch.setattr(ui_app, "_get_cached_content", lambda key, parts: "cachedContents/1")
+
+    with pytest.raises(errors.ClientError):
+        list(ui_app._remix_images([_upload("a.png", b"img")], "prompt", "key"))